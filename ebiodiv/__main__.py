@@ -1,7 +1,10 @@
-from . import server
+from . import server, storage
 
 
 def main():
+    # once, before the workers are started: the workers do not change the schema
+    server.configure_logging()
+    storage.migrate(server.CONFIG['database']['url'])
     server.run("ebiodiv.app:app")
 
 
@@ -1,12 +1,17 @@
 import logging
-import hashlib
+import threading
+from dataclasses import dataclass
 import orjson
-from typing import Dict, List, Optional, Any
+import cachetools
+from typing import Dict, Iterable, List, Optional, Any, Tuple
 
-from fastapi import Body, FastAPI, Request, Query, Depends
-from fastapi.middleware.gzip import GZipMiddleware
-from fastapi.responses import ORJSONResponse
+from brotli_asgi import BrotliMiddleware
+from fastapi import FastAPI, Request, Query, Depends, HTTPException
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
+from sqlalchemy import func, select
+from sqlalchemy.engine import Row
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.cors import CORSMiddleware
 
 from . import server, storage
@@ -15,6 +20,16 @@ logger = logging.getLogger(__name__)
 
 CONFIG = server.CONFIG
 
+MAX_OCCURRENCE_IDS = 10_000
+
+# dataHash -> Occurrence.id
+OCCURRENCE_ID_CACHE = cachetools.LRUCache(maxsize=100_000)
+OCCURRENCE_ID_CACHE_LOCK = threading.Lock()
+
+# (User.name, User.orcid) -> User.id
+USER_ID_CACHE = cachetools.LRUCache(maxsize=10_000)
+USER_ID_CACHE_LOCK = threading.Lock()
+
 
 app = FastAPI(
     title="eBioDiv - SIB server",
@@ -42,7 +57,11 @@ def get_db() -> storage.Session:
 
 @app.on_event("startup")
 async def startup_event():
-    storage.initialize(CONFIG['database']['url'])
+    storage.initialize(
+        CONFIG['database']['url'],
+        pool_size=CONFIG['database'].getint('pool_size', 10),
+        max_overflow=CONFIG['database'].getint('max_overflow', 20),
+    )
 
 
 async def catch_exceptions_middleware(request: Request, call_next):
@@ -62,9 +81,12 @@ async def catch_exceptions_middleware(request: Request, call_next):
 
 app.middleware("http")(catch_exceptions_middleware)
 
+# brotli for the clients which support it, gzip otherwise
 app.add_middleware(
-    GZipMiddleware,
-    minimum_size=1000
+    BrotliMiddleware,
+    quality=4,
+    minimum_size=1500,
+    gzip_fallback=True,
 )
 
 app.add_middleware(
@@ -96,96 +118,233 @@ class OccurrenceRelationsModel(BaseModel):
     relations: List[OcurrenceRelation]
 
 
-def get_user(session: storage.Session, user: User) -> storage.User:
-    userObj = session.query(storage.User).where(storage.User.name==user.name and storage.User.orcid==user.orcid).scalar()
-    if userObj is None:
-        userObj = storage.User(name=user.name, orcid=user.orcid)
-        session.add(userObj)
-        session.commit()
-    return userObj
-
-
-def get_hash(b: bytes):
-    m = hashlib.sha256()
-    m.update(b)
-    return m.hexdigest()
-
-
-def get_occurrence(session: storage.Session, occurrence: Dict[str, Any]) -> storage.Occurrence:
-    key = occurrence['key']
-    data = orjson.dumps(occurrence)
-    dataHash = get_hash(data)
-    occurrenceObj = session.query(storage.Occurrence).where(storage.Occurrence.dataHash==dataHash).scalar()
-    if occurrenceObj is None:
-        occurrenceObj = storage.Occurrence(
-            gbifKey=key,
-            datasetKey=occurrence.get('datasetKey'),
-            institutionKey=occurrence.get('institutionKey'),
-            publishingOrgKey=occurrence.get('publishingOrgKey'),
-            data=data.decode(),
-            dataHash=dataHash,
-        )
-        session.add(occurrenceObj)
-        session.commit()
-    return occurrenceObj
+# Output of /occurrenceRelations: orjson serializes the dataclasses natively,
+# __slots__ avoids a per-instance __dict__
+
+@dataclass
+class UserOut:
+    __slots__ = ('name', 'orcid')
+    name: str
+    orcid: Optional[str]
+
+
+@dataclass
+class OccurrenceRelationOut:
+    __slots__ = ('relatedOccurrenceId', 'decision', 'is_new_decision')
+    relatedOccurrenceId: int
+    decision: Optional[bool]
+    is_new_decision: bool
 
 
-@app.post("/newOcurrenceRelations")
+@dataclass
+class EventOut:
+    __slots__ = (
+        'id', 'timestamp', 'user', 'refOccurrenceId', 'refOccurrenceKey',
+        'datasetKey', 'institutionKey', 'publishingOrgKey', 'relations',
+    )
+    id: int
+    timestamp: Any
+    user: UserOut
+    refOccurrenceId: int
+    refOccurrenceKey: int
+    datasetKey: Optional[str]
+    institutionKey: Optional[str]
+    publishingOrgKey: Optional[str]
+    relations: List[OccurrenceRelationOut]
+
+
+def get_user_id(session: storage.Session, user: User) -> int:
+    """Return the id of the user, insert the user if unknown (not committed)"""
+    with USER_ID_CACHE_LOCK:
+        userId = USER_ID_CACHE.get((user.name, user.orcid))
+    if userId is not None:
+        return userId
+
+    def select_user_id():
+        return session.execute(
+            select(storage.User.id)
+            .where(storage.User.name == user.name, storage.USER_ORCID_KEY == (user.orcid or ''))
+            .limit(1)
+        ).scalars().first()
+
+    userId = select_user_id()
+    if userId is None:
+        # a concurrent request may have inserted the same user since the SELECT: it is skipped
+        storage.insert_ignore_conflicts(
+            session, storage.User, [{'name': user.name, 'orcid': user.orcid}], [storage.User.name, storage.USER_ORCID_KEY]
+        )
+        userId = select_user_id()
+    return userId
+
+
+def json_array_items(items, batch_size: int = storage.BATCH_SIZE):
+    """Serialize the items as the comma separated content of a JSON array, batch_size items per chunk
+
+    The values not supported by orjson (Decimal for example) are serialized with str()."""
+    first = True
+    batch = []
+    for item in items:
+        batch.append(orjson.dumps(item, default=str))
+        if len(batch) >= batch_size:
+            yield (b'' if first else b',') + b','.join(batch)
+            first = False
+            batch = []
+    if batch:
+        yield (b'' if first else b',') + b','.join(batch)
+
+
+def occurrences_to_json(occurrences: Iterable[Row]) -> bytes:
+    """Serialize {occurrence.id: occurrence.data}, the stored JSON is copied without being parsed"""
+    return b'{' + b','.join(
+        b'"%d":%b' % (occ.id, storage.decompress_data(occ.data))
+        for occ in occurrences
+    ) + b'}'
+
+
+def get_occurrence_ids(session: storage.Session, occurrences: List[Dict[str, Any]]) -> Tuple[List[str], List[int]]:
+    """Return the dataHash and the id of each occurrence, insert the unknown occurrences
+
+    The new occurrences are not committed."""
+    datas = [orjson.dumps(occurrence) for occurrence in occurrences]
+    dataHashes = [storage.get_hash(data) for data in datas]
+
+    # the id of an occurrence never changes once it is inserted
+    with OCCURRENCE_ID_CACHE_LOCK:
+        ids = {dataHash: OCCURRENCE_ID_CACHE[dataHash] for dataHash in dataHashes if dataHash in OCCURRENCE_ID_CACHE}
+
+    def select_ids(dataHashSet):
+        r = session.query(storage.Occurrence.id, storage.Occurrence.dataHash).where(storage.Occurrence.dataHash.in_(dataHashSet))
+        for occurrenceId, dataHash in r:
+            ids[dataHash] = occurrenceId
+
+    missingHashes = set(dataHashes) - ids.keys()
+    if missingHashes:
+        select_ids(missingHashes)
+
+    newOccurrences = {}
+    for occurrence, data, dataHash in zip(occurrences, datas, dataHashes):
+        if dataHash not in ids and dataHash not in newOccurrences:
+            newOccurrences[dataHash] = dict(
+                gbifKey=occurrence['key'],
+                datasetKey=occurrence.get('datasetKey'),
+                institutionKey=occurrence.get('institutionKey'),
+                publishingOrgKey=occurrence.get('publishingOrgKey'),
+                data=storage.compress_data(data),
+                dataHash=dataHash,
+            )
+    if newOccurrences:
+        # a concurrent request may have inserted the same occurrences since the SELECT: they are skipped
+        storage.insert_ignore_conflicts(session, storage.Occurrence, list(newOccurrences.values()), ['dataHash'])
+        select_ids(newOccurrences.keys())
+
+    return dataHashes, [ids[dataHash] for dataHash in dataHashes]
+
+
+@app.post("/newOcurrenceRelations", response_class=ORJSONResponse, response_model=None)
 async def occurrenceRelations(data: OccurrenceRelationsModel, session: storage.Session = Depends(get_db)):
-    user = get_user(session, data.user)
+    userId = get_user_id(session, data.user)
+    dataHashes, occurrenceIds = get_occurrence_ids(
+        session,
+        [data.refOccurrence] + [relation.occurrence for relation in data.relations]
+    )
     relationsObj = [
         storage.OccurrenceRelation(
-            relatedOccurrenceId=get_occurrence(session, relation.occurrence).id,
+            relatedOccurrenceId=relatedOccurrenceId,
             decision=relation.decision,
             isNewDecision=relation.is_new_decision,
         )
-        for relation in data.relations
+        for relation, relatedOccurrenceId in zip(data.relations, occurrenceIds[1:])
     ]
 
-    # commit the event
+    # commit the event, the user and the new occurrences at once
     session.add(storage.Event(
-        userId=user.id,
+        userId=userId,
         institutionKey=data.institutionKey,
         datasetKey=data.datasetKey,
-        refOccurrenceId=get_occurrence(session, data.refOccurrence).id,
+        refOccurrenceId=occurrenceIds[0],
         relations=relationsObj,
     ))
     session.commit()
-    return {'ok': True}
+    with USER_ID_CACHE_LOCK:
+        USER_ID_CACHE[(data.user.name, data.user.orcid)] = userId
+    with OCCURRENCE_ID_CACHE_LOCK:
+        OCCURRENCE_ID_CACHE.update(zip(dataHashes, occurrenceIds))
+    return ORJSONResponse(content={'ok': True})
 
 
-@app.post('/occurrences')
+@app.post('/occurrences', response_class=ORJSONResponse, response_model=None)
 async def occurrences(
     occurrenceIds: Optional[List[int]],
     session: storage.Session = Depends(get_db)
 ):
-    occurrences = {}
-    r = session.query(storage.Occurrence).where(storage.Occurrence.id.in_(occurrenceIds)).all()
-    for occ in r:
-        occ: storage.Occurrence = occ
-        occurrences[occ.id] = orjson.loads(occ.data)
-    return occurrences
+    # an id repeated in two chunks would be returned twice: duplicate keys in the JSON object
+    occurrenceIds = list(dict.fromkeys(occurrenceIds or []))
+    if len(occurrenceIds) > MAX_OCCURRENCE_IDS:
+        raise HTTPException(status_code=413, detail=f'At most {MAX_OCCURRENCE_IDS} occurrence ids are allowed')
+
+    def load_occurrences():
+        return occurrences_to_json(storage.get_occurrences_by_ids(session, occurrenceIds))
 
+    # the query and the decompression of large payloads must not block the event loop
+    content = await run_in_threadpool(load_occurrences)
+    return Response(content=content, media_type="application/json")
 
-@app.get("/occurrenceRelations")
+
+@app.get("/occurrenceRelations", response_class=ORJSONResponse, response_model=None)
 async def events(
+    request: Request,
     institutionKey: Optional[str] = None,
     datasetKey: Optional[str] = None,
     occurrenceKey: Optional[int] = None,
     eventId: Optional[int] = None,
+    beforeEventId: Optional[int] = None,
+    limit: int = Query(100, ge=1, le=1000),
     withOccurrence: bool = False,
     session: storage.Session = Depends(get_db)
 ):
-    q = session.query(storage.Event).join(storage.User, storage.User.id==storage.Event.userId).join(storage.Occurrence, storage.Occurrence.id==storage.Event.refOccurrenceId)
+    conditions = []
     if institutionKey:
-        q = q.where(storage.Occurrence.institutionKey == institutionKey)
+        conditions.append(storage.Occurrence.institutionKey == institutionKey)
     if datasetKey:
-        q = q.where(storage.Occurrence.datasetKey == datasetKey)
+        conditions.append(storage.Occurrence.datasetKey == datasetKey)
     if occurrenceKey:
-        q = q.where(storage.Occurrence.gbifKey == occurrenceKey)
+        conditions.append(storage.Occurrence.gbifKey == occurrenceKey)
     if eventId:
-        q = q.where(storage.Event.id == eventId)
-    events = []
+        conditions.append(storage.Event.id == eventId)
+    # keyset pagination: the client sends back nextCursor as beforeEventId to get the next page
+    if beforeEventId:
+        conditions.append(storage.Event.id < beforeEventId)
+
+    # read only: columns are selected, no ORM object is built
+    def select_events(*columns):
+        return select(*columns).select_from(storage.Event)\
+            .join(storage.User, storage.User.id==storage.Event.userId)\
+            .join(storage.Occurrence, storage.Occurrence.id==storage.Event.refOccurrenceId)\
+            .where(*conditions)
+
+    def select_etag_values():
+        return session.execute(select_events(func.max(storage.Event.id), func.count(storage.Event.id))).one()
+
+    # the events are never modified: the last id and the number of the matching events identify the response
+    # the aggregate may scan all the events: it must not block the event loop
+    maxEventId, matchCount = await run_in_threadpool(select_etag_values)
+    etag = f'W/"{maxEventId or 0}-{matchCount}"'
+    headers = {'ETag': etag, 'Cache-Control': 'private, must-revalidate'}
+    ifNoneMatch = request.headers.get('if-none-match')
+    if ifNoneMatch and (ifNoneMatch.strip() == '*' or etag in map(str.strip, ifNoneMatch.split(','))):
+        return Response(status_code=304, headers=headers)
+
+    stmt = select_events(
+        storage.Event.id,
+        storage.Event.timestamp,
+        storage.User.name.label('userName'),
+        storage.User.orcid.label('userOrcid'),
+        storage.Event.refOccurrenceId,
+        storage.Occurrence.gbifKey.label('refOccurrenceKey'),
+        storage.Occurrence.datasetKey,
+        storage.Occurrence.institutionKey,
+        storage.Occurrence.publishingOrgKey,
+    ).order_by(storage.Event.id.desc()).limit(limit)
 
     occurrenceIdSet = set()
     def addToOccurrenceIdSet(occId):
@@ -194,40 +353,51 @@ async def events(
             occurrenceIdSet.add(occId)
         return occId
 
-    events = [
-        {
-            'id': event.id,
-            'timestamp': event.timestamp,
-            'user': {
-                'name': event.user.name,
-                'orcid': event.user.orcid, 
-            },
-            'refOccurrenceId': addToOccurrenceIdSet(event.refOccurrenceId),
-            'refOccurrenceKey': event.refOccurrence.gbifKey,
-            'datasetKey': event.refOccurrence.datasetKey,
-            'institutionKey': event.refOccurrence.institutionKey,
-            'publishingOrgKey': event.refOccurrence.publishingOrgKey,
-            'relations': [
-                {
-                    'relatedOccurrenceId': addToOccurrenceIdSet(r.relatedOccurrenceId),
-                    'decision': r.decision,
-                    'is_new_decision': r.isNewDecision,
-                }
-                for r in event.relations
-            ]
-        }
-        for event in q.all()
-    ]
-    results = {
-        'events': events
-    }
-
-    if withOccurrence:
-        occurrences = {}
-        r = session.query(storage.Occurrence).where(storage.Occurrence.id.in_(occurrenceIdSet)).all()
-        for occ in r:
-            occ: storage.Occurrence = occ
-            occurrences[occ.id] = orjson.loads(occ.data)
-        results['occurrences'] = occurrences
-
-    return results
+    def to_relation(row: Row) -> OccurrenceRelationOut:
+        return OccurrenceRelationOut(
+            relatedOccurrenceId=addToOccurrenceIdSet(row.relatedOccurrenceId),
+            decision=row.decision,
+            is_new_decision=row.isNewDecision,
+        )
+
+    lastEventId = None
+    eventCount = 0
+    def iter_events():
+        nonlocal lastEventId, eventCount
+        result = session.execute(stmt, execution_options={'yield_per': storage.BATCH_SIZE})
+        # one query for the relations of each batch of events
+        for rows in result.partitions():
+            relations = storage.get_relations_by_event_ids(session, [row.id for row in rows], to_relation)
+            for row in rows:
+                lastEventId = row.id
+                eventCount += 1
+                yield EventOut(
+                    id=row.id,
+                    timestamp=row.timestamp,
+                    user=UserOut(
+                        name=row.userName,
+                        orcid=row.userOrcid,
+                    ),
+                    refOccurrenceId=addToOccurrenceIdSet(row.refOccurrenceId),
+                    refOccurrenceKey=row.refOccurrenceKey,
+                    datasetKey=row.datasetKey,
+                    institutionKey=row.institutionKey,
+                    publishingOrgKey=row.publishingOrgKey,
+                    relations=relations[row.id],
+                )
+
+    # generate is a synchronous generator: StreamingResponse iterates it in the thread pool,
+    # the queries and the JSON encoding do not block the event loop
+    def generate():
+        # the events are fetched and sent by batch: the whole result is never in memory
+        yield b'{"events":['
+        yield from json_array_items(iter_events())
+        yield b']'
+        nextCursor = lastEventId if eventCount == limit else None
+        yield b',"nextCursor":' + orjson.dumps(nextCursor)
+        if withOccurrence:
+            r = storage.get_occurrences_by_ids(session, list(occurrenceIdSet))
+            yield b',"occurrences":' + occurrences_to_json(r)
+        yield b'}'
+
+    return StreamingResponse(generate(), media_type="application/json", headers=headers)
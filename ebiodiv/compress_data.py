@@ -0,0 +1,39 @@
+import orjson
+from sqlalchemy import text
+
+from ebiodiv import server, storage
+
+
+CONFIG = server.CONFIG
+
+
+def main():
+    """Compress Occurrence.data of a database created when the column was JSON"""
+    storage.initialize(CONFIG['database']['url'])
+    session = storage.getSession()
+
+    count = 0
+    lastId = 0
+    while True:
+        rows = session.execute(
+            text('SELECT id, data FROM occurrences WHERE id > :lastId ORDER BY id LIMIT :limit'),
+            {'lastId': lastId, 'limit': storage.BATCH_SIZE}
+        ).all()
+        if not rows:
+            break
+        for occurrenceId, data in rows:
+            if isinstance(data, str):
+                # the JSON column stored the serialized occurrence as a JSON string
+                data = storage.compress_data(orjson.loads(data).encode())
+                session.execute(
+                    text('UPDATE occurrences SET data = :data WHERE id = :id'),
+                    {'data': data, 'id': occurrenceId}
+                )
+                count += 1
+        lastId = rows[-1][0]
+        session.commit()
+    print(f'{count} occurrences compressed')
+
+
+if __name__ == '__main__':
+    main()
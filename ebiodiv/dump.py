@@ -1,67 +1,77 @@
-import logging
-import hashlib
+import shutil
+import tempfile
 import orjson
-from typing import Dict, List, Optional, Any
+from typing import Dict, Any
+
+from sqlalchemy import select
+from sqlalchemy.engine import Row
 
 from ebiodiv import server, storage
 
 
 CONFIG = server.CONFIG
 
-def divide_chunks(l, n):
-    for i in range(0, len(l), n): 
-        yield l[i:i + n]
-
 
 def main():
     storage.initialize(CONFIG['database']['url'])
     session = storage.getSession()
 
-    #
-    q = session.query(storage.Event).join(storage.User, storage.User.id==storage.Event.userId).join(storage.Occurrence, storage.Occurrence.id==storage.Event.refOccurrenceId)
-    events = []
+    stmt = select(
+        storage.Event.id,
+        storage.Event.timestamp,
+        storage.User.name.label('userName'),
+        storage.User.orcid.label('userOrcid'),
+        storage.Event.refOccurrenceId,
+        storage.Occurrence.data.label('refOccurrenceData'),
+    ).select_from(storage.Event)\
+        .join(storage.User, storage.User.id==storage.Event.userId)\
+        .join(storage.Occurrence, storage.Occurrence.id==storage.Event.refOccurrenceId)
 
-    occurrenceIdSet = set()
-    def addToOccurrenceIdSet(occId):
-        nonlocal occurrenceIdSet
-        occurrenceIdSet.add(occId)
-        return occId
+    with  open('output.json', 'wb') as f, tempfile.TemporaryFile() as occurrencesFile:
+        # the occurrences are written to occurrencesFile as they appear in the events,
+        # the data is already serialized JSON: it is written as it is once decompressed, without parsing it
+        occurrenceIdSet = set()
+        def addOccurrence(occurrenceId: int, data: bytes):
+            if occurrenceId not in occurrenceIdSet:
+                if occurrenceIdSet:
+                    occurrencesFile.write(b',')
+                occurrencesFile.write(b'"%d":%b' % (occurrenceId, storage.decompress_data(data)))
+                occurrenceIdSet.add(occurrenceId)
+            return str(occurrenceId)
 
-    events = [
-        {
-            'id': event.id,
-            'timestamp': event.timestamp,
-            'user': {
-                'name': event.user.name,
-                'orcid': event.user.orcid, 
-            },
-            'occurrenceId': str(addToOccurrenceIdSet(event.refOccurrenceId)),
-            'relations': [
-                {
-                    'relatedOccurrenceId': str(addToOccurrenceIdSet(r.relatedOccurrenceId)),
-                    'decision': r.decision,
-                    'is_new_decision': r.isNewDecision,
-                }
-                for r in event.relations
-            ]
-        }
-        for event in q.all()
-    ]
+        def to_relation(row: Row) -> Dict[str, Any]:
+            return {
+                'relatedOccurrenceId': addOccurrence(row.relatedOccurrenceId, row.data),
+                'decision': row.decision,
+                'is_new_decision': row.isNewDecision,
+            }
 
-    occurrences = {}
-    for occurrenceIdSubSet in divide_chunks(list(occurrenceIdSet), 100):
-        r = session.query(storage.Occurrence).where(storage.Occurrence.id.in_(occurrenceIdSubSet)).all()
-        for occ in r:
-            occ: storage.Occurrence = occ
-            occurrences[str(occ.id)] = orjson.loads(occ.data)
-            
-    results = {
-        'events': events,
-        'occurrences': occurrences,
-    }
+        # events are fetched by batch of storage.BATCH_SIZE and written one by one
+        f.write(b'{"events":[')
+        first = True
+        result = session.execute(stmt, execution_options={'yield_per': storage.BATCH_SIZE})
+        for rows in result.partitions():
+            relations = storage.get_relations_by_event_ids(session, [row.id for row in rows], to_relation, with_occurrence_data=True)
+            for row in rows:
+                if not first:
+                    f.write(b',')
+                f.write(orjson.dumps({
+                    'id': row.id,
+                    'timestamp': row.timestamp,
+                    'user': {
+                        'name': row.userName,
+                        'orcid': row.userOrcid, 
+                    },
+                    'occurrenceId': addOccurrence(row.refOccurrenceId, row.refOccurrenceData),
+                    'relations': relations[row.id],
+                }))
+                first = False
+        f.write(b']')
 
-    with  open('output.json', 'wb') as f:
-        f.write(orjson.dumps(results))
+        f.write(b',"occurrences":{')
+        occurrencesFile.seek(0)
+        shutil.copyfileobj(occurrencesFile, f)
+        f.write(b'}}')
 
 
 if __name__ == '__main__':
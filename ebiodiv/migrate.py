@@ -0,0 +1,14 @@
+from ebiodiv import server, storage
+
+
+CONFIG = server.CONFIG
+
+
+def main():
+    """Upgrade the schema of the database, ebiodiv-backend does it at startup"""
+    server.configure_logging()
+    storage.migrate(CONFIG['database']['url'])
+
+
+if __name__ == '__main__':
+    main()
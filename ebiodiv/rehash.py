@@ -0,0 +1,24 @@
+from ebiodiv import server, storage
+
+
+CONFIG = server.CONFIG
+
+
+def main():
+    """Recompute Occurrence.dataHash after a change of storage.get_hash"""
+    storage.initialize(CONFIG['database']['url'])
+    session = storage.getSession()
+
+    count = 0
+    for occ in session.query(storage.Occurrence).yield_per(storage.BATCH_SIZE):
+        occ: storage.Occurrence = occ
+        occ.dataHash = storage.get_hash(storage.decompress_data(occ.data))
+        count += 1
+        if count % storage.BATCH_SIZE == 0:
+            session.flush()
+    session.commit()
+    print(f'{count} occurrences rehashed')
+
+
+if __name__ == '__main__':
+    main()
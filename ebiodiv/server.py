@@ -1,7 +1,10 @@
 import os
 import sys
+import atexit
+import queue
 import configparser
 import logging
+import logging.handlers
 import multiprocessing
 import argparse
 import cProfile
@@ -65,8 +68,65 @@ CONFIG = read_config()
 
 ## LOGGING
 
+class LogQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # the listener runs in the same process: the record is formatted by the listener thread,
+        # including the traceback of logger.exception
+        return record
+
+
+# the same handler for the lifetime of the process: the gunicorn and uvicorn loggers keep a reference to it
+LOG_QUEUE_HANDLER = LogQueueHandler(queue.SimpleQueue())
+LOG_QUEUE_LISTENER = None
+
+
+def start_log_queue_listener(handlers):
+    global LOG_QUEUE_LISTENER
+    LOG_QUEUE_LISTENER = logging.handlers.QueueListener(LOG_QUEUE_HANDLER.queue, *handlers, respect_handler_level=True)
+    LOG_QUEUE_LISTENER.start()
+
+
+def configure_log_queue():
+    """Move the root handlers behind a queue: the caller (the event loop) does not wait for formatting and I/O"""
+    # one listener per queue
+    stop_log_queue()
+    handlers = [h for h in logging.root.handlers if h is not LOG_QUEUE_HANDLER]
+    for handler in logging.root.handlers[:]:
+        logging.root.removeHandler(handler)
+    logging.root.addHandler(LOG_QUEUE_HANDLER)
+    start_log_queue_listener(handlers)
+
+
+def stop_log_queue():
+    global LOG_QUEUE_LISTENER
+    if LOG_QUEUE_LISTENER is not None:
+        # flush the pending records, then give back the handlers to the root logger
+        LOG_QUEUE_LISTENER.stop()
+        logging.root.removeHandler(LOG_QUEUE_HANDLER)
+        for handler in LOG_QUEUE_LISTENER.handlers:
+            logging.root.addHandler(handler)
+        LOG_QUEUE_LISTENER = None
+
+
+def restart_log_queue_after_fork():
+    # the listener thread does not exist in the child (gunicorn workers),
+    # and the records queued by the parent are the parent's ones
+    LOG_QUEUE_HANDLER.queue = queue.SimpleQueue()
+    if LOG_QUEUE_LISTENER is not None:
+        start_log_queue_listener(LOG_QUEUE_LISTENER.handlers)
+
+
+if hasattr(os, 'register_at_fork'):
+    # no fork on Windows
+    os.register_at_fork(after_in_child=restart_log_queue_after_fork)
+
+
+atexit.register(stop_log_queue)
+
+
 def configure_logging():
     global ARGS
+    stop_log_queue()
     log_level = "INFO" if ARGS.production else "DEBUG"
     log_format = LOG_FORMAT_PROD if ARGS.production else LOG_FORMAT_DEBUG
 
@@ -104,6 +164,7 @@ def configure_logging():
         milliseconds=True,
         isatty=isatty,
     )
+    configure_log_queue()
 
 
 def configure_app(app):
@@ -123,8 +184,9 @@ if gunicorn:
             self.access_logger = logging.getLogger("gunicorn.access")
             self.error_logger.setLevel("INFO")
             self.access_logger.setLevel("INFO")
-            self.access_logger.addHandler(logging.root.handlers[0])
-            self.error_logger.addHandler(logging.root.handlers[0])
+            # UvicornWorker copies these handlers to the uvicorn loggers
+            self.access_logger.addHandler(LOG_QUEUE_HANDLER)
+            self.error_logger.addHandler(LOG_QUEUE_HANDLER)
             self.error_logger.propagate = False
             self.access_logger.propagate = False
 
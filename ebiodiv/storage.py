@@ -1,12 +1,28 @@
-from sqlalchemy import create_engine
+import logging
+from collections import defaultdict
+from typing import Any, Callable, Dict, Iterator, List, Set, TypeVar
+
+import blake3
+import zstandard
+from sqlalchemy import and_, bindparam, create_engine, insert, inspect, literal_column, select, text, update, MetaData, Table
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session, relationship
-from sqlalchemy import Column, String, Text, Integer, Time, Boolean, ForeignKey, JSON
+from sqlalchemy import Column, String, Integer, Boolean, ForeignKey, Index, LargeBinary
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.engine import Row, make_url
+from sqlalchemy.exc import DBAPIError, IntegrityError
 from sqlalchemy.sql import func
 
 
+logger = logging.getLogger(__name__)
+
+# rows per query or per batch: yield_per, IN lists and keyset batches
+BATCH_SIZE = 500
+
 Base = declarative_base()
 
+T = TypeVar('T')
+
 
 class User(Base):
     __tablename__ = "users"
@@ -18,15 +34,28 @@ class User(Base):
         return f"<User id={self.id!r}, name={self.name!r} orcid={self.orcid!r}>"
 
 
+# the orcid is optional and NULL values never conflict: the users without orcid are unique on their name
+# (a literal, not a bound parameter: ON CONFLICT must match the expression of the index)
+USER_ORCID_KEY = func.coalesce(User.orcid, literal_column("''"))
+Index('ux_users_name_orcid', User.name, USER_ORCID_KEY, unique=True)
+
+
 class Occurrence(Base):
     __tablename__ = "occurrences"
+    __table_args__ = (
+        # required by insert_ignore_conflicts
+        Index('ux_occurrences_dataHash', 'dataHash', unique=True),
+        # /occurrenceRelations filters on datasetKey, institutionKey or both
+        Index('ix_occurrences_datasetKey_institutionKey', 'datasetKey', 'institutionKey'),
+    )
     id = Column(Integer, primary_key=True, index=True)
     gbifKey = Column(Integer, index=True)
     datasetKey = Column(String(36))
-    institutionKey = Column(String(36))
+    institutionKey = Column(String(36), index=True)
     publishingOrgKey = Column(String(36))
-    data = Column(JSON, index=True)
-    dataHash = Column(String(64), index=True)
+    # zstd compressed JSON, see compress_data and decompress_data
+    data = Column(LargeBinary)
+    dataHash = Column(String(64))
     timestamp = Column(Integer, server_default=func.now())
 
     def __repr__(self):
@@ -35,6 +64,9 @@ class Occurrence(Base):
 
 class Event(Base):
     __tablename__ = "events"
+    __table_args__ = (
+        Index('ix_events_refOccurrenceId_timestamp', 'refOccurrenceId', 'timestamp'),
+    )
     id = Column(Integer, primary_key=True, index=True)
     refOccurrenceId = Column(Integer, ForeignKey('occurrences.id'))
     refOccurrence = relationship("Occurrence")
@@ -60,6 +92,88 @@ class OccurrenceRelation(Base):
         return f"<OccurrenceRelation eventid={self.eventid!r} relatedOccurrenceId={self.relatedOccurrenceId!r} decision={self.decision!r} isNewDecision={self.isNewDecision!r}>"
 
 
+def get_hash(b: bytes) -> str:
+    # Occurrence.dataHash is only used to deduplicate the occurrences: there is no need for a cryptographic hash
+    return blake3.blake3(b).hexdigest()
+
+
+def compress_data(data: bytes) -> bytes:
+    return zstandard.compress(data, 3)
+
+
+def decompress_data(data: bytes) -> bytes:
+    return zstandard.decompress(data)
+
+
+def insert_ignore_conflicts(session: Session, model, values: List[Dict[str, Any]], index_elements: List[Any]):
+    """INSERT the rows, except the ones conflicting with an existing row on the unique index_elements"""
+    dialect_name = session.get_bind().dialect.name
+    if dialect_name == 'postgresql':
+        stmt = postgresql.insert(model).on_conflict_do_nothing(index_elements=index_elements)
+    elif dialect_name == 'sqlite':
+        stmt = sqlite.insert(model).on_conflict_do_nothing(index_elements=index_elements)
+    elif dialect_name in ('mysql', 'mariadb'):
+        # unlike INSERT IGNORE, the other errors are still raised
+        stmt = mysql.insert(model)
+        stmt = stmt.on_duplicate_key_update({'id': model.__table__.c.id})
+    else:
+        insert_ignore_conflicts_with_savepoints(session, model, values)
+        return
+    session.execute(stmt, values)
+
+
+def insert_ignore_conflicts_with_savepoints(session: Session, model, values: List[Dict[str, Any]]):
+    """INSERT the rows one by one, each in a SAVEPOINT rolled back on conflict
+
+    For the databases without an INSERT ... ON CONFLICT statement"""
+    for value in values:
+        try:
+            with session.begin_nested():
+                session.execute(insert(model), [value])
+        except IntegrityError:
+            pass
+
+
+def divide_chunks(l, n):
+    for i in range(0, len(l), n): 
+        yield l[i:i + n]
+
+
+def get_occurrences_by_ids(session: Session, occurrenceIds: List[int], chunk_size: int = BATCH_SIZE) -> Iterator[Row]:
+    """Yield the (id, data) rows of the occurrences, chunk_size ids per query"""
+    # only the id and the data columns are loaded, no Occurrence object is built
+    for occurrenceIdSubSet in divide_chunks(occurrenceIds, chunk_size):
+        yield from session.execute(
+            select(Occurrence.id, Occurrence.data).where(Occurrence.id.in_(occurrenceIdSubSet))
+        )
+
+
+def get_relations_by_event_ids(
+    session: Session,
+    eventIds: List[int],
+    to_relation: Callable[[Row], T],
+    with_occurrence_data: bool = False,
+) -> Dict[int, List[T]]:
+    """Return {eventid: [to_relation(row), ...]} for the occurrence relations of the events
+
+    The rows have the eventid, relatedOccurrenceId, decision and isNewDecision columns,
+    and the data of the related occurrence with with_occurrence_data."""
+    # read only: columns are selected, no ORM object is built
+    stmt = select(
+        OccurrenceRelation.eventid,
+        OccurrenceRelation.relatedOccurrenceId,
+        OccurrenceRelation.decision,
+        OccurrenceRelation.isNewDecision,
+    )
+    if with_occurrence_data:
+        stmt = stmt.add_columns(Occurrence.data)\
+            .join(Occurrence, Occurrence.id==OccurrenceRelation.relatedOccurrenceId)
+    relations = defaultdict(list)
+    for row in session.execute(stmt.where(OccurrenceRelation.eventid.in_(eventIds))):
+        relations[row.eventid].append(to_relation(row))
+    return relations
+
+
 _SessionLocal = None
 
 
@@ -69,22 +183,139 @@ def getSession() -> Session:
     return _SessionLocal()
 
 
-def initialize(url):
+def get_index_names(engine, table_name: str) -> Set[str]:
+    """Return the names of the indexes of the table, including the expression-based indexes"""
+    # the reflection skips the expression-based indexes, Index.create(checkfirst=True) as well
+    dialect_name = engine.dialect.name
+    with engine.connect() as connection:
+        if dialect_name == 'sqlite':
+            rows = connection.execute(
+                text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table_name"),
+                {'table_name': table_name}
+            )
+        elif dialect_name == 'postgresql':
+            rows = connection.execute(
+                text("SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = :table_name"),
+                {'table_name': table_name}
+            )
+        else:
+            return {index['name'] for index in inspect(connection).get_indexes(table_name)}
+        return {row[0] for row in rows}
+
+
+def remove_duplicates(engine, index: Index):
+    """Delete the rows conflicting on the unique index, except the one with the lowest id
+
+    The foreign keys referencing a deleted row are moved to the kept row."""
+    table = index.table
+    expressions = list(index.expressions)
+    keptRows = select(
+        func.min(table.c.id).label('keptId'),
+        *[expression.label(f'expression{i}') for i, expression in enumerate(expressions)]
+    ).group_by(*expressions).having(func.count() > 1).subquery()
+    # NULL never conflicts in a unique index, the join skips these rows
+    duplicates = select(table.c.id, keptRows.c.keptId).join(keptRows, and_(
+        table.c.id != keptRows.c.keptId,
+        *[expression == keptRows.c[f'expression{i}'] for i, expression in enumerate(expressions)]
+    ))
+    foreignKeys = [
+        foreignKey.parent
+        for referencingTable in Base.metadata.sorted_tables
+        for foreignKey in referencingTable.foreign_keys
+        if foreignKey.column is table.c.id
+    ]
+
+    with engine.begin() as connection:
+        keptIds = connection.execute(duplicates).all()
+        if not keptIds:
+            return
+        logger.warning('%d duplicates found in %s, required by the unique index %s: delete them', len(keptIds), table.name, index.name)
+        for duplicateIdSubSet in divide_chunks(keptIds, BATCH_SIZE):
+            values = [{'duplicateId': duplicateId, 'keptId': keptId} for duplicateId, keptId in duplicateIdSubSet]
+            for column in foreignKeys:
+                connection.execute(
+                    update(column.table).where(column == bindparam('duplicateId')).values({column.name: bindparam('keptId')}),
+                    values
+                )
+            connection.execute(table.delete().where(table.c.id.in_([duplicateId for duplicateId, _ in duplicateIdSubSet])))
+
+
+# (table name, index name) created by the previous versions of the schema
+OBSOLETE_INDEXES = [
+    # Occurrence.data was an indexed JSON column: a copy of all the occurrences
+    ('occurrences', 'ix_occurrences_data'),
+    # replaced by the unique index ux_occurrences_dataHash
+    ('occurrences', 'ix_occurrences_dataHash'),
+    # leading column of ix_occurrences_datasetKey_institutionKey
+    ('occurrences', 'ix_occurrences_datasetKey'),
+]
+
+
+def drop_obsolete_indexes(engine):
+    for table_name, index_name in OBSOLETE_INDEXES:
+        table = Table(table_name, MetaData(), autoload_with=engine)
+        index = next((index for index in table.indexes if index.name == index_name), None)
+        if index is None:
+            continue
+        logger.info('Drop the index %s', index_name)
+        try:
+            index.drop(bind=engine)
+        except DBAPIError:
+            # dropped by another process in the meantime
+            if index_name in get_index_names(engine, table_name):
+                raise
+
+
+def create_missing_indexes(engine):
+    # create_all skips the existing tables, including the indexes added after their creation
+    for table in Base.metadata.sorted_tables:
+        indexNames = get_index_names(engine, table.name)
+        for index in table.indexes:
+            if index.name in indexNames:
+                continue
+            if index.unique:
+                remove_duplicates(engine, index)
+            # the server must not start without the unique indexes: insert_ignore_conflicts relies on them
+            logger.info('Create the index %s', index.name)
+            try:
+                index.create(bind=engine)
+            except DBAPIError:
+                # created by another process in the meantime
+                if index.name not in get_index_names(engine, table.name):
+                    raise
+
+
+def initialize(url, pool_size: int = 10, max_overflow: int = 20):
     global _SessionLocal
-    # check_same_thread only for sqlite :
-    # https://fastapi.tiangolo.com/tutorial/sql-databases/?h=session#note
-    engine = create_engine(url, connect_args={"check_same_thread": False})
-    Base.metadata.create_all(engine)
+    if make_url(url).get_backend_name() == 'sqlite':
+        # check_same_thread only for sqlite :
+        # https://fastapi.tiangolo.com/tutorial/sql-databases/?h=session#note
+        engine = create_engine(url, connect_args={"check_same_thread": False})
+    else:
+        # database server: keep the connections open between the requests
+        engine = create_engine(url, pool_size=pool_size, max_overflow=max_overflow, pool_pre_ping=True)
     _SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 
+def migrate(url):
+    """Create the tables and the indexes, drop the obsolete indexes
+
+    Run once before the workers are started (see ebiodiv.__main__ and ebiodiv.migrate): initialize does not change the schema."""
+    engine = create_engine(url)
+    try:
+        Base.metadata.create_all(engine)
+        drop_obsolete_indexes(engine)
+        create_missing_indexes(engine)
+    finally:
+        engine.dispose()
+
+
 def schema_graph_write():
-    from sqlalchemy import MetaData
     from sqlalchemy_schemadisplay import create_schema_graph
     from . import server
 
     database_url = server.CONFIG['database']['url']
-    initialize(server.CONFIG['database']['url'])
+    migrate(database_url)
 
     # create the pydot graph object by autoloading all tables via a bound metadata object
     graph = create_schema_graph(metadata=MetaData(database_url),
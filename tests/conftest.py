@@ -0,0 +1,34 @@
+import sys
+
+import pytest
+
+# ebiodiv.server parses the command line when it is imported: hide the pytest arguments
+sys.argv = sys.argv[:1]
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+from ebiodiv import app as ebiodiv_app, server, storage  # noqa: E402
+
+
+@pytest.fixture
+def database_url(tmp_path, monkeypatch):
+    url = f"sqlite:///{tmp_path / 'db.sqlite'}"
+    monkeypatch.setitem(server.CONFIG['database'], 'url', url)
+    return url
+
+
+@pytest.fixture
+def database(database_url):
+    # as ebiodiv.__main__ before the server starts
+    storage.migrate(database_url)
+    storage.initialize(database_url)
+    return database_url
+
+
+@pytest.fixture
+def client(database):
+    # the caches map to the ids of the previous test database
+    ebiodiv_app.OCCURRENCE_ID_CACHE.clear()
+    ebiodiv_app.USER_ID_CACHE.clear()
+    with TestClient(ebiodiv_app.app) as c:
+        yield c
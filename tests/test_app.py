@@ -0,0 +1,126 @@
+from decimal import Decimal
+
+import orjson
+from sqlalchemy import func, select
+
+from ebiodiv import app as ebiodiv_app, storage
+
+
+def occurrence(key, **kwargs):
+    return {
+        'key': key,
+        'datasetKey': 'ds1',
+        'institutionKey': 'inst1',
+        'publishingOrgKey': 'pub1',
+        **kwargs,
+    }
+
+
+def post_relations(client, refKey, relatedKeys, user=None):
+    r = client.post('/newOcurrenceRelations', json={
+        'institutionKey': 'inst1',
+        'datasetKey': 'ds1',
+        'user': user or {'name': 'alice', 'orcid': '0000-0001'},
+        'refOccurrence': occurrence(refKey),
+        'relations': [
+            {'occurrence': occurrence(key), 'decision': True, 'is_new_decision': True}
+            for key in relatedKeys
+        ],
+    })
+    assert r.status_code == 200, r.text
+    assert r.json() == {'ok': True}
+
+
+def test_json_array_items_default_str():
+    items = [{'value': Decimal('1.5')}, {'value': 2}]
+    content = b'[' + b''.join(ebiodiv_app.json_array_items(items, batch_size=1)) + b']'
+    assert orjson.loads(content) == [{'value': '1.5'}, {'value': 2}]
+
+
+def test_occurrence_relations(client):
+    post_relations(client, 100, [200, 300])
+    post_relations(client, 101, [300])
+
+    r = client.get('/occurrenceRelations', params={'withOccurrence': True})
+    assert r.status_code == 200
+    assert r.headers['content-type'] == 'application/json'
+    body = r.json()
+    assert [event['refOccurrenceKey'] for event in body['events']] == [101, 100]
+    assert body['events'][0]['user'] == {'name': 'alice', 'orcid': '0000-0001'}
+    assert body['nextCursor'] is None
+    # the shared occurrence 300 is stored once
+    assert sorted(occ['key'] for occ in body['occurrences'].values()) == [100, 101, 200, 300]
+
+    r = client.get('/occurrenceRelations', params={'institutionKey': 'unknown'})
+    assert r.json() == {'events': [], 'nextCursor': None}
+
+
+def test_occurrence_relations_pagination(client):
+    for key in range(5):
+        post_relations(client, key, [])
+
+    eventIds = []
+    params = {'limit': 2}
+    while True:
+        body = client.get('/occurrenceRelations', params=params).json()
+        eventIds += [event['id'] for event in body['events']]
+        if body['nextCursor'] is None:
+            break
+        params['beforeEventId'] = body['nextCursor']
+    assert eventIds == [5, 4, 3, 2, 1]
+
+
+def test_occurrence_relations_etag(client):
+    post_relations(client, 100, [200])
+
+    r = client.get('/occurrenceRelations')
+    etag = r.headers['etag']
+    r = client.get('/occurrenceRelations', headers={'If-None-Match': etag})
+    assert r.status_code == 304
+    assert r.content == b''
+
+    post_relations(client, 101, [200])
+    r = client.get('/occurrenceRelations', headers={'If-None-Match': etag})
+    assert r.status_code == 200
+    assert r.headers['etag'] != etag
+
+
+def test_occurrences(client):
+    post_relations(client, 100, [200])
+
+    r = client.post('/occurrences', json=[1, 2, 3])
+    assert r.status_code == 200
+    assert r.headers['content-type'] == 'application/json'
+    assert {key: occ['key'] for key, occ in r.json().items()} == {'1': 100, '2': 200}
+
+
+def test_occurrences_repeated_ids(client):
+    post_relations(client, 100, [])
+
+    r = client.post('/occurrences', json=[1] + [999] * 500 + [1])
+    assert r.status_code == 200
+    assert r.content.count(b'"1":') == 1
+    assert list(r.json()) == ['1']
+
+
+def test_occurrences_too_many_ids(client):
+    r = client.post('/occurrences', json=list(range(ebiodiv_app.MAX_OCCURRENCE_IDS + 1)))
+    assert r.status_code == 413
+    # the limit applies to the distinct ids
+    r = client.post('/occurrences', json=[1] * (ebiodiv_app.MAX_OCCURRENCE_IDS + 1))
+    assert r.status_code == 200
+
+
+def test_user_without_orcid(client):
+    for _ in range(2):
+        post_relations(client, 100, [], user={'name': 'bob', 'orcid': None})
+        # another worker process: the user is not in its cache
+        ebiodiv_app.USER_ID_CACHE.clear()
+
+    events = client.get('/occurrenceRelations').json()['events']
+    assert [event['user'] for event in events] == [{'name': 'bob', 'orcid': None}] * 2
+    session = storage.getSession()
+    try:
+        assert session.execute(select(func.count(storage.User.id))).scalar() == 1
+    finally:
+        session.close()
@@ -0,0 +1,45 @@
+import logging
+import os
+
+import pytest
+
+from ebiodiv import server
+
+
+@pytest.fixture
+def log_file(tmp_path):
+    path = tmp_path / 'log.txt'
+    handler = logging.FileHandler(path)
+    rootHandlers = logging.root.handlers[:]
+    logging.root.handlers = [handler]
+    server.configure_log_queue()
+    try:
+        yield path
+    finally:
+        server.stop_log_queue()
+        logging.root.handlers = rootHandlers
+        handler.close()
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='no fork on Windows')
+def test_log_queue_after_fork(log_file):
+    # the gunicorn loggers are configured before the workers are forked
+    logger = logging.getLogger('gunicorn.test')
+    logger.addHandler(server.LOG_QUEUE_HANDLER)
+    logger.propagate = False
+    try:
+        pid = os.fork()
+        if pid == 0:
+            try:
+                logger.error('child')
+                logging.getLogger('ebiodiv.test').error('child root')
+                server.stop_log_queue()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        logger.error('parent')
+        server.stop_log_queue()
+    finally:
+        logger.removeHandler(server.LOG_QUEUE_HANDLER)
+
+    assert sorted(log_file.read_text().splitlines()) == ['child', 'child root', 'parent']
@@ -0,0 +1,136 @@
+import os
+
+import pytest
+from sqlalchemy import create_engine, select, text
+
+from ebiodiv import storage
+
+
+def test_migrate_removes_duplicate_occurrences(database_url):
+    # a database created before the unique index on Occurrence.dataHash
+    engine = create_engine(database_url)
+    storage.Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(text('DROP INDEX "ux_occurrences_dataHash"'))
+        connection.execute(storage.Occurrence.__table__.insert(), [
+            {'id': 1, 'gbifKey': 1, 'dataHash': 'a'},
+            {'id': 2, 'gbifKey': 1, 'dataHash': 'a'},
+            {'id': 3, 'gbifKey': 2, 'dataHash': 'b'},
+            {'id': 4, 'gbifKey': 1, 'dataHash': 'a'},
+        ])
+        connection.execute(storage.Event.__table__.insert(), [
+            {'id': 1, 'refOccurrenceId': 2},
+            {'id': 2, 'refOccurrenceId': 3},
+        ])
+        connection.execute(storage.OccurrenceRelation.__table__.insert(), [
+            {'eventid': 1, 'relatedOccurrenceId': 4},
+            {'eventid': 2, 'relatedOccurrenceId': 1},
+        ])
+    engine.dispose()
+
+    storage.migrate(database_url)
+
+    storage.initialize(database_url)
+    session = storage.getSession()
+    try:
+        assert session.execute(select(storage.Occurrence.id).order_by(storage.Occurrence.id)).scalars().all() == [1, 3]
+        assert session.execute(select(storage.Event.refOccurrenceId).order_by(storage.Event.id)).scalars().all() == [1, 3]
+        assert session.execute(select(storage.OccurrenceRelation.relatedOccurrenceId)).scalars().all() == [1, 1]
+        storage.insert_ignore_conflicts(session, storage.Occurrence, [{'gbifKey': 1, 'dataHash': 'a'}], ['dataHash'])
+        assert session.execute(select(storage.Occurrence.id).order_by(storage.Occurrence.id)).scalars().all() == [1, 3]
+    finally:
+        session.close()
+
+
+def test_migrate_removes_duplicate_users(database_url):
+    # users without orcid inserted twice before the unique index on (name, coalesce(orcid, ''))
+    engine = create_engine(database_url)
+    storage.Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(text('DROP INDEX ux_users_name_orcid'))
+        connection.execute(storage.User.__table__.insert(), [
+            {'id': 1, 'name': 'bob', 'orcid': None},
+            {'id': 2, 'name': 'bob', 'orcid': None},
+            {'id': 3, 'name': 'bob', 'orcid': '0000-0001'},
+        ])
+        connection.execute(storage.Event.__table__.insert(), [{'id': 1, 'userId': 2}])
+    engine.dispose()
+
+    storage.migrate(database_url)
+
+    storage.initialize(database_url)
+    session = storage.getSession()
+    try:
+        assert session.execute(select(storage.User.id).order_by(storage.User.id)).scalars().all() == [1, 3]
+        assert session.execute(select(storage.Event.userId)).scalars().all() == [1]
+    finally:
+        session.close()
+
+
+def test_insert_ignore_conflicts_with_savepoints(database):
+    session = storage.getSession()
+    try:
+        storage.insert_ignore_conflicts(
+            session, storage.User, [{'name': 'bob', 'orcid': None}], [storage.User.name, storage.USER_ORCID_KEY]
+        )
+        storage.insert_ignore_conflicts_with_savepoints(session, storage.User, [
+            {'name': 'bob', 'orcid': None},
+            {'name': 'alice', 'orcid': None},
+        ])
+        session.commit()
+        rows = session.execute(select(storage.User.id, storage.User.name).order_by(storage.User.id)).all()
+        assert [tuple(row) for row in rows] == [(1, 'bob'), (2, 'alice')]
+    finally:
+        session.close()
+
+
+def test_migrate_drops_obsolete_indexes(database_url):
+    engine = create_engine(database_url)
+    storage.Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(text('CREATE INDEX ix_occurrences_data ON occurrences (data)'))
+        connection.execute(text('CREATE INDEX "ix_occurrences_dataHash" ON occurrences ("dataHash")'))
+        connection.execute(text('CREATE INDEX "ix_occurrences_datasetKey" ON occurrences ("datasetKey")'))
+    engine.dispose()
+
+    storage.migrate(database_url)
+
+    engine = create_engine(database_url)
+    indexNames = storage.get_index_names(engine, 'occurrences')
+    assert 'ix_occurrences_data' not in indexNames
+    assert 'ix_occurrences_dataHash' not in indexNames
+    assert 'ix_occurrences_datasetKey' not in indexNames
+    assert 'ux_occurrences_dataHash' in indexNames
+    engine.dispose()
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='no fork on Windows')
+def test_migrate_concurrently(database_url):
+    # a database created before the indexes of this version
+    engine = create_engine(database_url)
+    storage.Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(text('DROP INDEX "ux_occurrences_dataHash"'))
+        connection.execute(text('CREATE INDEX ix_occurrences_data ON occurrences (data)'))
+        connection.execute(text('CREATE INDEX "ix_occurrences_dataHash" ON occurrences ("dataHash")'))
+    engine.dispose()
+
+    pids = []
+    for _ in range(8):
+        pid = os.fork()
+        if pid == 0:
+            exitCode = 1
+            try:
+                storage.migrate(database_url)
+                exitCode = 0
+            finally:
+                os._exit(exitCode)
+        pids.append(pid)
+    exitCodes = [os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1]) for pid in pids]
+    assert exitCodes == [0] * 8
+
+    engine = create_engine(database_url)
+    indexNames = storage.get_index_names(engine, 'occurrences')
+    assert 'ix_occurrences_data' not in indexNames
+    assert 'ux_occurrences_dataHash' in indexNames
+    engine.dispose()